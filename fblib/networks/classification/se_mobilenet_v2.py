@@ -6,11 +6,11 @@
 #
 import os
 import math
-
-from collections import OrderedDict
+from functools import lru_cache
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from fblib.util.mypath import Path
 
@@ -41,6 +41,64 @@ def conv_1x1_bn(inp, oup):
     )
 
 
+@lru_cache(maxsize=None)
+def _build_plan(width_mult=1., input_channel=32):
+    """Channel plan of the inverted residual blocks, as (inp, hidden_dim, oup, stride, expand_ratio) tuples."""
+    interverted_residual_setting = [
+        # t, c, n, s
+        [1, 16, 1, 1],
+        [6, 24, 2, 2],
+        [6, 32, 3, 2],
+        [6, 64, 4, 2],
+        [6, 96, 3, 1],
+        [6, 160, 3, 2],
+        [6, 320, 1, 1],
+    ]
+
+    plan = []
+    input_channel = int(input_channel * width_mult)
+    for t, c, n, s in interverted_residual_setting:
+        output_channel = int(c * width_mult)
+        for i in range(n):
+            plan.append((input_channel, round(input_channel * t), output_channel, s if i == 0 else 1, t))
+            input_channel = output_channel
+
+    return tuple(plan)
+
+
+def fuse_conv_bn(conv, bn):
+    """Fold an (inference-mode) BatchNorm2d into the weights and bias of the preceding Conv2d."""
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                      padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=True)
+
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+
+    fused.weight.data = (conv.weight * scale.reshape(-1, 1, 1, 1)).detach()
+    fused.bias.data = (bn.bias + (bias - bn.running_mean) * scale).detach()
+
+    return fused.to(conv.weight.device)
+
+
+def _make_conv_block(expand, inp, hidden_dim, oup, stride):
+    layers = []
+    if expand:
+        # pw
+        layers += [nn.Conv2d(inp, hidden_dim, 1, 1, 0, bias=False),
+                   nn.BatchNorm2d(hidden_dim),
+                   nn.ReLU6(inplace=True)]
+    layers += [
+        # dw
+        nn.Conv2d(hidden_dim, hidden_dim, 3, stride, 1, groups=hidden_dim, bias=False),
+        nn.BatchNorm2d(hidden_dim),
+        nn.ReLU6(inplace=True),
+        # pw-linear
+        nn.Conv2d(hidden_dim, oup, 1, 1, 0, bias=False),
+        nn.BatchNorm2d(oup),
+    ]
+    return nn.Sequential(*layers)
+
+
 class SEMobile(nn.Module):
     def __init__(self, channel, reduction=4):
         super(SEMobile, self).__init__()
@@ -49,116 +107,145 @@ class SEMobile(nn.Module):
             nn.Linear(channel, channel // reduction),
             nn.ReLU6(inplace=True),
             nn.Linear(channel // reduction, channel),
-            nn.Sigmoid()
         )
 
-    def forward(self, x):
+    def _scale(self, x):
         b, c, _, _ = x.size()
         y = self.avg_pool(x).view(b, c)
-        y = self.fc(y).view(b, c, 1, 1)
-        return x * y
+
+        # Call the two Linear layers directly (activations are functional), keeping the fc.0 / fc.2 checkpoint keys
+        y = F.relu6(self.fc[0](y))
+        y = torch.sigmoid(self.fc[2](y))
+        return y.view(b, c, 1, 1)
+
+    def forward(self, x):
+        return x * self._scale(x)
 
 
 class InvertedResidual(nn.Module):
-    def __init__(self, inp, oup, stride, expand_ratio):
+    # Compile-time constant under TorchScript, so each scripted block keeps a single branch
+    __constants__ = ['use_res_connect']
+
+    def __init__(self, inp, hidden_dim, oup, stride, expand_ratio, se_layer=SEMobile):
         super(InvertedResidual, self).__init__()
         self.stride = stride
         assert stride in [1, 2]
 
-        hidden_dim = round(inp * expand_ratio)
         self.use_res_connect = self.stride == 1 and inp == oup
 
-        if expand_ratio == 1:
-            self.conv = nn.Sequential(
-                # dw
-                nn.Conv2d(hidden_dim, hidden_dim, 3, stride, 1, groups=hidden_dim, bias=False),
-                nn.BatchNorm2d(hidden_dim),
-                nn.ReLU6(inplace=True),
-                # pw-linear
-                nn.Conv2d(hidden_dim, oup, 1, 1, 0, bias=False),
-                nn.BatchNorm2d(oup),
-            )
-        else:
-            self.conv = nn.Sequential(
-                # pw
-                nn.Conv2d(inp, hidden_dim, 1, 1, 0, bias=False),
-                nn.BatchNorm2d(hidden_dim),
-                nn.ReLU6(inplace=True),
-                # dw
-                nn.Conv2d(hidden_dim, hidden_dim, 3, stride, 1, groups=hidden_dim, bias=False),
-                nn.BatchNorm2d(hidden_dim),
-                nn.ReLU6(inplace=True),
-                # pw-linear
-                nn.Conv2d(hidden_dim, oup, 1, 1, 0, bias=False),
-                nn.BatchNorm2d(oup),
-            )
-
-        self.se = SEMobile(channel=oup, reduction=4)
+        self.conv = _make_conv_block(expand_ratio != 1, inp, hidden_dim, oup, stride)
+
+        self.se = se_layer(channel=oup, reduction=4)
 
     def forward(self, x):
-        if self.use_res_connect:
-            out = self.conv(x)
+        out = self.conv(x)
+        if torch.is_grad_enabled():
             out = self.se(out)
-            return x + out
         else:
-            out = self.conv(x)
-            out = self.se(out)
+            # Inference: out was just produced by self.conv and is not referenced elsewhere, scale it in place
+            out = out.mul_(self.se._scale(out))
+        if self.use_res_connect:
+            # out is a fresh tensor that autograd does not need to keep, accumulate into it
+            return out.add_(x)
+        else:
             return out
 
 
 class SEMobileNetV2(nn.Module):
-    def __init__(self, n_class=1000, input_size=224, width_mult=1., last_channel=1280):
+    __constants__ = ['dropout_p']
+
+    def __init__(self, n_class=1000, input_size=224, width_mult=1., last_channel=1280, block=InvertedResidual):
         super(SEMobileNetV2, self).__init__()
-        block = InvertedResidual
-        input_channel = 32
-        interverted_residual_setting = [
-            # t, c, n, s
-            [1, 16, 1, 1],
-            [6, 24, 2, 2],
-            [6, 32, 3, 2],
-            [6, 64, 4, 2],
-            [6, 96, 3, 1],
-            [6, 160, 3, 2],
-            [6, 320, 1, 1],
-        ]
+        plan = _build_plan(width_mult)
 
         assert input_size % 32 == 0
-        input_channel = int(input_channel * width_mult)
         self.last_channel = int(last_channel * width_mult) if width_mult > 1.0 else last_channel
 
         # build first layer
-        self.features = [conv_bn(3, input_channel, 2)]
+        self.features = [conv_bn(3, plan[0][0], 2)]
 
         # build inverted residual blocks
-        for t, c, n, s in interverted_residual_setting:
-            output_channel = int(c * width_mult)
-            for i in range(n):
-                if i == 0:
-                    self.features.append(block(input_channel, output_channel, s, expand_ratio=t))
-                else:
-                    self.features.append(block(input_channel, output_channel, 1, expand_ratio=t))
-                input_channel = output_channel
+        for inp, hidden_dim, oup, stride, t in plan:
+            self.features.append(block(inp, hidden_dim, oup, stride, expand_ratio=t))
 
         # build last layers
-        self.features.append(conv_1x1_bn(input_channel, self.last_channel))
+        self.features.append(conv_1x1_bn(plan[-1][2], self.last_channel))
 
         # make it nn.Sequential
         self.features = nn.Sequential(*self.features)
 
-        # build classifier
-        self.classifier = nn.Sequential(
-            nn.Dropout(0.2),
-            nn.Linear(self.last_channel, n_class),
-        )
+        # build classifier (dropout is applied functionally in _classify)
+        self.dropout_p = 0.2
+        self.classifier = nn.Linear(self.last_channel, n_class)
+
+        # ImageNet normalization as x * in_scale + in_shift, i.e. (x - mean) / std in a single addcmul
+        mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+        std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+        self.register_buffer('in_scale', 1. / std, persistent=False)
+        self.register_buffer('in_shift', -mean / std, persistent=False)
+
+        self.normalize = False
+        self.channels_last = False
+        self.fp16 = False
 
         self._initialize_weights()
 
     def forward(self, x):
-        x = self.features(x)
-        x = x.mean(3).mean(2)
-        x = self.classifier(x)
+        x = self._normalize_input(x)
+        x = self._extract_features(x)
+        x = self._classify(x)
+        return x
+
+    def _normalize_input(self, x):
+        if self.normalize:
+            x = torch.addcmul(self.in_shift, x, self.in_scale)
         return x
 
+    def _extract_features(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.fp16 and x.is_cuda:
+            x = self._features_fp16(x)
+        else:
+            x = self.features(x)
+        return F.adaptive_avg_pool2d(x, 1).flatten(1)
+
+    def _classify(self, x):
+        x = F.dropout(x, self.dropout_p, self.training)
+        return self.classifier(x)
+
+    @torch.jit.unused
+    def _features_fp16(self, x):
+        # Convs run in FP16 on tensor cores; BN and SE follow the input dtype (also FP16).
+        # The output is cast back to FP32 before pooling and the classifier.
+        with torch.autocast(device_type='cuda', dtype=torch.float16):
+            x = self.features(x)
+        return x.float()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints store the classifier as nn.Sequential(nn.Dropout, nn.Linear)
+        for name in ('weight', 'bias'):
+            old_key = prefix + 'classifier.1.' + name
+            if old_key in state_dict:
+                state_dict[prefix + 'classifier.' + name] = state_dict.pop(old_key)
+        super(SEMobileNetV2, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def fuse_bn(self):
+        """Fold every BatchNorm2d of the network into the preceding Conv2d, for inference only."""
+        for m in self.modules():
+            if not isinstance(m, nn.Sequential):
+                continue
+            for i in range(len(m) - 1):
+                if isinstance(m[i], nn.Conv2d) and isinstance(m[i + 1], nn.BatchNorm2d):
+                    m[i] = fuse_conv_bn(m[i], m[i + 1])
+                    m[i + 1] = nn.Identity()
+        return self
+
+    def to_channels_last(self):
+        """Store weights and activations as NHWC, so that depthwise and 1x1 convs hit the native NHWC kernels."""
+        self.channels_last = True
+        return self.to(memory_format=torch.channels_last)
+
     def _initialize_weights(self):
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
@@ -170,7 +257,6 @@ class SEMobileNetV2(nn.Module):
                 m.weight.data.fill_(1)
                 m.bias.data.zero_()
             elif isinstance(m, nn.Linear):
-                n = m.weight.size(1)
                 m.weight.data.normal_(0, 0.01)
                 m.bias.data.zero_()
 
@@ -182,21 +268,114 @@ class SEMobileNetV2Features(SEMobileNetV2):
                                                     input_size=input_size,
                                                     width_mult=width_mult,
                                                     last_channel=last_channel)
+        self.skip_classifier = False
 
-    def forward(self, x):
-        x = self.features(x)
-        features = x.mean(3).mean(2)
-        x = self.classifier(features)
+    def forward(self, x, return_logits: bool = True):
+        x = self._normalize_input(x)
+        features = self._extract_features(x)
+        if self.skip_classifier or not return_logits:
+            return None, features
+        x = self._classify(features)
 
         return x, features
 
+    def drop_classifier(self):
+        """Remove the classifier weights, for callers that only consume the features."""
+        self.skip_classifier = True
+        self.classifier = nn.Sequential()
+        return self
 
-def se_mobilenet_v2(pretrained=False, features=False, n_class=1000, last_channel=1280, remote=True):
 
-    if not features:
-        model = SEMobileNetV2(n_class=n_class, last_channel=last_channel)
-    else:
+class QuantizableSEMobile(SEMobile):
+    def __init__(self, channel, reduction=4):
+        super(QuantizableSEMobile, self).__init__(channel=channel, reduction=reduction)
+        self.mul = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        return self.mul.mul(x, self._scale(x))
+
+
+class QuantizableInvertedResidual(InvertedResidual):
+    def __init__(self, inp, hidden_dim, oup, stride, expand_ratio):
+        super(QuantizableInvertedResidual, self).__init__(inp, hidden_dim, oup, stride, expand_ratio,
+                                                          se_layer=QuantizableSEMobile)
+        self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        out = self.conv(x)
+        out = self.se(out)
+        if self.use_res_connect:
+            return self.skip_add.add(x, out)
+        else:
+            return out
+
+
+class QuantizableSEMobileNetV2(SEMobileNetV2):
+    """SE-MobileNet-v2 that can be post-training quantized to INT8 (see quantize_model)."""
+
+    def __init__(self, n_class=1000, input_size=224, width_mult=1., last_channel=1280):
+        super(QuantizableSEMobileNetV2, self).__init__(n_class=n_class,
+                                                       input_size=input_size,
+                                                       width_mult=width_mult,
+                                                       last_channel=last_channel,
+                                                       block=QuantizableInvertedResidual)
+        self.quant = torch.quantization.QuantStub()
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, x):
+        x = self._normalize_input(x)
+        x = self.quant(x)
+        x = self._extract_features(x)
+        x = self._classify(x)
+        x = self.dequant(x)
+        return x
+
+    def fuse_model(self):
+        # ReLU6 has no fused quantized kernel, so only (Conv2d, BatchNorm2d) pairs are fused
+        for m in self.modules():
+            if not isinstance(m, nn.Sequential):
+                continue
+            for i in range(len(m) - 1):
+                if isinstance(m[i], nn.Conv2d) and isinstance(m[i + 1], nn.BatchNorm2d):
+                    torch.quantization.fuse_modules(m, [str(i), str(i + 1)], inplace=True)
+
+
+def quantize_model(model, data_loader, backend='fbgemm', num_batches=32):
+    """Post-training static INT8 quantization of a QuantizableSEMobileNetV2, calibrated on data_loader."""
+    model.eval()
+    model.fuse_model()
+
+    torch.backends.quantized.engine = backend
+    model.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(model, inplace=True)
+
+    # Calibrate the activation observers
+    with torch.no_grad():
+        for i, (images, _) in enumerate(data_loader):
+            if i >= num_batches:
+                break
+            model(images)
+
+    torch.quantization.convert(model, inplace=True)
+
+    return model
+
+
+def se_mobilenet_v2(pretrained=False, features=False, n_class=1000, last_channel=1280, remote=True,
+                    channels_last=False, jit=False, quantizable=False, fp16=False, classifier=True,
+                    normalize=False, torch_compile=False):
+
+    assert features or classifier, 'The classifier can only be dropped from the feature extractor (features=True)'
+    assert not (fp16 and jit), 'The FP16 autocast path cannot be scripted'
+    assert not (torch_compile and jit), 'Select either TorchScript or torch.compile'
+
+    if features:
+        assert not quantizable, 'Quantization is not supported for the feature extractor'
         model = SEMobileNetV2Features(n_class=n_class, last_channel=last_channel)
+    elif quantizable:
+        model = QuantizableSEMobileNetV2(n_class=n_class, last_channel=last_channel)
+    else:
+        model = SEMobileNetV2(n_class=n_class, last_channel=last_channel)
 
     if pretrained:
         print('Loading Imagenet pre-trained SE-MobileNet-v2')
@@ -206,21 +385,43 @@ def se_mobilenet_v2(pretrained=False, features=False, n_class=1000, last_channel
             checkpoint = load_state_dict_from_url(model_urls['se_mobilenet_v2_1280'], map_location='cpu', progress=True)
         else:
             checkpoint = torch.load(
-                os.path.join(Path.models_dir(), 'se_mobilenet_v2_1280.pth'), map_location=lambda storage, loc: storage)
+                os.path.join(Path.models_dir(), 'se_mobilenet_v2_1280.pth'), map_location='cpu', weights_only=True)
         checkpoint = checkpoint['model_state']
 
-        # Handle DataParallel
-        if 'module.' in list(checkpoint.keys())[0]:
-            new_state_dict = OrderedDict()
-            for k, v in checkpoint.items():
-                name = k.replace('module.', '')  # remove `module.`
-                new_state_dict[name] = v
+        # Handle DataParallel (remove `module.`)
+        if next(iter(checkpoint)).startswith('module.'):
+            new_state_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in checkpoint.items()}
         else:
             new_state_dict = checkpoint
 
         # Load pre-trained IN model
         model.load_state_dict(new_state_dict)
 
+    if features and not classifier:
+        model = model.drop_classifier()
+
+    if normalize:
+        # Inputs are expected in [0, 1], ImageNet normalization runs inside the network
+        model.normalize = True
+
+    if channels_last:
+        # Let cuDNN pick the fastest (depthwise) algorithm for the NHWC layout
+        torch.backends.cudnn.benchmark = True
+        model = model.to_channels_last()
+
+    if fp16:
+        # Mixed precision on CUDA inputs; pair with channels_last for the NHWC tensor-core kernels
+        model.fp16 = True
+
+    if jit:
+        # Inference only: fold BN, compile and let the JIT fuse Conv+ReLU6 / Conv+add chains
+        model = model.eval().fuse_bn()
+        model = torch.jit.optimize_for_inference(torch.jit.script(model))
+
+    if torch_compile:
+        # Specialize to a static input shape; on CUDA 'reduce-overhead' replays the network as a single CUDA graph
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=True, dynamic=False)
+
     return model
 
 
@@ -236,20 +437,14 @@ def test_reproduce():
         'https://gist.githubusercontent.com/yrevar/6135f1bd8dcf2e0cc683/raw/d133d61a09d7e5a3b36b8c111a8dd5c4b5d560ee'
         '/imagenet1000_clsid_to_human.pkl'))
 
-    model = se_mobilenet_v2(pretrained=True)
+    model = se_mobilenet_v2(pretrained=True, normalize=True)
 
-    mean = [0.485, 0.456, 0.406]
-    std = [0.229, 0.224, 0.225]
     img = cv2.imread(os.path.join(PROJECT_ROOT_DIR, 'util/img/cat.jpg')).astype(np.float32) / 255.
 
     img = cv2.resize(img, dsize=(224, 224))
-    img = (img - mean) / std
-
-    img = img[:, :, :, np.newaxis]
-    img = img.transpose((3, 2, 0, 1))
-    img = torch.from_numpy(img.astype(np.float32))
+    img = torch.from_numpy(img).permute(2, 0, 1).unsqueeze(0)
 
-    model = model.eval()
+    model = model.eval().fuse_bn()
     with torch.no_grad():
         output = model(img)
         output = torch.nn.functional.softmax(output, dim=1)